@@ -1,20 +1,72 @@
 import json
 from flask import Flask, request, jsonify
-from werkzeug.utils import secure_filename
 import torch
 from flask_cors import CORS, cross_origin
 from pathlib import Path
 import os
-from backend.transfer.main import SmiskiClassifier 
+from backend.transfer.main import SmiskiClassifier, DEVICE
+from backend.api.batcher import Batcher
+
+MODEL_PATH = "backend/models/smiski_classifier.pt"
+ONNX_PATH = "backend/models/smiski_classifier.onnx"
+
+# split the cores between server workers instead of letting each one grab them all
+NUM_THREADS = max(1, (os.cpu_count() or 1) // max(1, int(os.environ.get("GUNICORN_WORKERS", "1"))))
+torch.set_num_threads(NUM_THREADS)
+torch.set_num_interop_threads(1)
+
+def onnx_is_current():
+    # a retrained .pt that's newer than the exported graph wins, so CPU hosts never serve a stale model
+    onnx_path, model_path = Path(ONNX_PATH), Path(MODEL_PATH)
+    if not onnx_path.exists():
+        return False
+    return not model_path.exists() or onnx_path.stat().st_mtime >= model_path.stat().st_mtime
 
 app = Flask(__name__)
 CORS(app, resources={r"/api/*": {"origins": ["http://localhost:3000"]}}, supports_credentials=True)
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
-app.config['UPLOAD_FOLDER'] = '/tmp'
 
-clf = SmiskiClassifier()
-clf.build_model()
-clf.load("backend/models/smiski_classifier.pt")
+if DEVICE.type == "cpu" and onnx_is_current():
+    # on CPU-only boxes ONNX Runtime's fused kernels beat the PyTorch forward
+    print(f"serving {ONNX_PATH} with ONNX Runtime")
+    clf = SmiskiClassifier(device=DEVICE)
+    clf.load_onnx(ONNX_PATH, num_threads=NUM_THREADS)
+else:
+    print(f"serving {MODEL_PATH} with TorchScript on {DEVICE}")
+    clf = SmiskiClassifier()
+    clf.build_model()
+    clf.load(MODEL_PATH)
+    if clf.device.type == "cuda":
+        clf.to_half()
+
+    # ResNet50 has no data-dependent control flow, so tracing is safe
+    clf.model.eval()
+    with torch.no_grad():
+        example = torch.zeros(1, 3, 224, 224, device=clf.device, dtype=clf.dtype).contiguous(memory_format=clf.memory_format)
+        traced = torch.jit.trace(clf.model, example)
+        traced = torch.jit.freeze(traced)
+        traced = torch.jit.optimize_for_inference(traced)
+    clf.model = traced
+
+MAX_BATCH_SIZE = 16
+input_buffer = torch.zeros(MAX_BATCH_SIZE, 3, 224, 224, device=clf.device, dtype=clf.dtype)
+if clf.session is None:
+    # match the layout predict_batch feeds the torch model, so there's no per-batch copy;
+    # ONNX Runtime wants contiguous NCHW, so the ORT path keeps the plain buffer
+    input_buffer = input_buffer.contiguous(memory_format=clf.memory_format)
+
+# warm up twice per size: the second call is the one that finishes JIT profiling/fusion and
+# kernel selection. Both specialise on input shape, so WARMUP_ALL_BATCH_SIZES=1 sweeps every
+# size the batcher can produce (slow on CPU); by default only the common 1 and full batches
+if os.environ.get("WARMUP_ALL_BATCH_SIZES") == "1":
+    warmup_sizes = range(1, MAX_BATCH_SIZE + 1)
+else:
+    warmup_sizes = (1, MAX_BATCH_SIZE)
+for n in warmup_sizes:
+    for _ in range(2):
+        clf.predict_batch(input_buffer[:n])
+
+batcher = Batcher(clf.predict_batch, max_batch_size=MAX_BATCH_SIZE, max_delay_ms=10, buffer=input_buffer)
 
 @app.route('/api/predict', methods=['POST'])
 @cross_origin(origin="http://localhost:3000")
@@ -26,18 +78,16 @@ def predict():
         file = request.files['image']
         if file.filename == '':
             return jsonify({"error": "No file selected"}), 400
-        filename = secure_filename(file.filename)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
-        result = clf.predict(filepath)
-        os.remove(filepath)
+        # uploads are capped by MAX_CONTENT_LENGTH, so decode straight from memory
+        x = clf.preprocess(file.read())
+        result = batcher.submit(x).result(timeout=5)
         
         return jsonify({
             "prediction": "Smiski" if result['pred'] == 1 else "Non-Smiski", 
-            "confidence": float(result['probs'][result['pred']]), 
+            "confidence": result['probs'][result['pred']], 
             "probabilities": {
-                "smiski": float(result['probs'][1]), 
-                "non_smiski": float(result['probs'][0])
+                "smiski": result['probs'][1], 
+                "non_smiski": result['probs'][0]
             }
         })
     except Exception as e:
@@ -50,4 +100,4 @@ def health():
 
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", debug=True, port=5050)
\ No newline at end of file
+    app.run(host="0.0.0.0", debug=True, port=5050, threaded=True)
\ No newline at end of file
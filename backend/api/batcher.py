@@ -0,0 +1,65 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import torch
+
+
+class Batcher:
+    """Groups concurrent single-image requests into one forward pass.
+
+    Handlers submit a preprocessed (3, H, W) tensor and wait on the returned
+    future; a background thread collects up to ``max_batch_size`` items, or
+    whatever arrived within ``max_delay_ms`` of the first one, and runs them
+    through ``predict_batch`` together. If ``buffer`` is given, batches are
+    copied into that preallocated (max_batch_size, 3, H, W) tensor instead of
+    being stacked into a fresh one each time.
+    """
+
+    def __init__(self, predict_batch, max_batch_size=16, max_delay_ms=10, buffer=None):
+        self.predict_batch = predict_batch
+        self.buffer = buffer
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay_ms / 1000.0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="smiski-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, x):
+        fut = Future()
+        self._queue.put((x, fut))
+        return fut
+
+    def _drain(self):
+        items = [self._queue.get()]
+        deadline = time.monotonic() + self.max_delay
+        while len(items) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                items.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return items
+
+    def _collate(self, xs):
+        if self.buffer is None:
+            return torch.stack(xs)
+        batch = self.buffer[:len(xs)]
+        for row, x in zip(batch, xs):
+            row.copy_(x)
+        return batch
+
+    def _run(self):
+        while True:
+            xs, futs = zip(*self._drain())
+            try:
+                results = self.predict_batch(self._collate(xs))
+            except Exception as e:
+                for fut in futs:
+                    fut.set_exception(e)
+                continue
+            for fut, result in zip(futs, results):
+                fut.set_result(result)
@@ -1,36 +1,44 @@
 from pathlib import Path
 import json
+import os
 
 DATA_DIR = "/Users/giomhern/04 Projects/is-it-a-smiski/data/raw"
+IMAGE_EXTS = {"jpg", "jpeg", "png", "webp"}
 
 def load_data():
     image_paths = []
     labels = []
 
-    def resolve_record_path(rec, class_dir, manifest_parent):
+    def list_files(class_dir):
+        with os.scandir(class_dir) as it:
+            return {e.name for e in it if e.is_file()}
+
+    def in_class_dir(p, class_dir, names):
+        # answer from the directory listing when we can, stat only for files elsewhere
+        if p.parent == class_dir:
+            return p.name in names
+        return p.exists()
+
+    def resolve_record_path(rec, class_dir, names):
         fp = rec.get("filepath") or rec.get("file") or rec.get("filename")
         if fp:
             p = Path(fp)
-            if p.is_absolute() and p.exists():
+            # downloader records are relative to its cwd (e.g. data/raw/smiski/x.jpg), so the
+            # name lookup is the common hit and avoids any stat before the path fallbacks
+            if p.name in names:
+                return class_dir / p.name
+            if p.is_absolute() and in_class_dir(p, class_dir, names):
                 return p
             try:
-                cand = (manifest_parent / fp).resolve()
-                if cand.exists():
-                    return cand
-            except Exception:
-                pass
-            try:
-                cand = class_dir / Path(fp).name
-                if cand.exists():
+                cand = (class_dir / fp).resolve()
+                if in_class_dir(cand, class_dir, names):
                     return cand
             except Exception:
                 pass
 
         fn = rec.get("filename")
-        if fn:
-            cand = class_dir / fn
-            if cand.exists():
-                return cand
+        if fn and fn in names:
+            return class_dir / fn
 
         return None
 
@@ -39,6 +47,8 @@ def load_data():
         manifest_path = class_dir / "download_manifest.jsonl"
 
         if manifest_path.exists() and manifest_path.stat().st_size > 0:
+            class_dir = class_dir.resolve()
+            names = list_files(class_dir)
             with manifest_path.open("r", encoding="utf-8") as fh:
                 for line_no, line in enumerate(fh, start=1):
                     line = line.strip()
@@ -50,7 +60,7 @@ def load_data():
                         print(f"warning: invalid json on line {line_no} in {manifest_path}, skipping")
                         continue
 
-                    p = resolve_record_path(rec, class_dir, manifest_path.parent)
+                    p = resolve_record_path(rec, class_dir, names)
                     if p:
                         image_paths.append(str(p))
                         labels.append(label_value)
@@ -60,13 +70,13 @@ def load_data():
             if not class_dir.exists():
                 print(f"warning: class directory does not exist: {class_dir}, skipping")
                 continue
-            exts = ("*.jpg", "*.jpeg", "*.png", "*.webp")
             found_any = False
-            for ext in exts:
-                for p in class_dir.glob(ext):
-                    image_paths.append(str(p))
-                    labels.append(label_value)
-                    found_any = True
+            with os.scandir(class_dir) as it:
+                for e in it:
+                    if e.is_file() and e.name.rpartition(".")[2] in IMAGE_EXTS:
+                        image_paths.append(e.path)
+                        labels.append(label_value)
+                        found_any = True
             if not found_any:
                 print(f"warning: no manifest and no images found in {class_dir}, skipping")
 
@@ -1,13 +1,20 @@
 import torch
 import torchvision 
 import torch.nn as nn 
+import torch.nn.functional as F
 import torch.optim as optim 
-import torchvision.transforms as transforms 
+from torchvision.transforms import v2
+import torchvision.transforms.v2.functional as TF
+from torchvision.io import read_file, decode_image, decode_jpeg, ImageReadMode
 from torchvision import models
 from torchvision.models import ResNet50_Weights
 from torch.utils.data import DataLoader, Dataset 
 from PIL import Image 
+import numpy as np
 import os 
+import io
+import math
+import inspect
 from pathlib import Path
 from sklearn.model_selection import train_test_split
 import json 
@@ -17,25 +24,34 @@ DATA_DIR = "data/raw"
 BATCH_SIZE = 32
 EPOCHS = 10 
 LEARNING_RATE = 0.001
+NUM_WORKERS = max(1, (os.cpu_count() or 2) // 2)
 DEVICE = torch.device("cuda" if torch.cuda.is_available() else "mps" if torch.backends.mps.is_available() else "cpu")
+IMG_SIZE = 224
+MEAN = [0.485, 0.456, 0.406]
+STD = [0.229, 0.224, 0.225]
 
-# data transforms 
-train_transforms = transforms.Compose([
-    transforms.Resize((224, 224)),
-    transforms.RandomHorizontalFlip(),
-    transforms.RandomRotation(10),
-    transforms.ToTensor(),
-    transforms.Normalize(mean=[0.485, 0.456, 0.406],
-                        std=[0.229, 0.224, 0.225])
-])
-val_transforms = transforms.Compose([
-    transforms.Resize((224, 224)),
-    transforms.RandomHorizontalFlip(),
-    transforms.RandomRotation(10),
-    transforms.ToTensor(),
-    transforms.Normalize(mean=[0.485, 0.456, 0.406],
-                        std=[0.229, 0.224, 0.225])
-])
+# data transforms: workers only resize to uint8; flip/rotate/normalize run
+# batched on the device (see SmiskiClassifier._augment / _normalize)
+base_transforms = v2.Resize((IMG_SIZE, IMG_SIZE), antialias=True)
+MAX_ROTATION = 10
+
+def read_image(src, device="cpu"):
+    """Decode an image file path or encoded bytes straight to a uint8 CHW RGB tensor on ``device``.
+
+    JPEGs are decoded with nvjpeg when ``device`` is CUDA; everything else is
+    decoded on the CPU and moved over.
+    """
+    device = torch.device(device)
+    in_memory = isinstance(src, (bytes, bytearray))
+    data = torch.frombuffer(bytearray(src), dtype=torch.uint8) if in_memory else read_file(str(src))
+    try:
+        if device.type == "cuda" and data[:2].tolist() == [0xFF, 0xD8]:
+            return decode_jpeg(data, mode=ImageReadMode.RGB, device=device)
+        return decode_image(data, mode=ImageReadMode.RGB).to(device)
+    except RuntimeError:
+        # formats this torchvision build can't decode (e.g. webp on older releases)
+        fp = io.BytesIO(src) if in_memory else str(src)
+        return TF.pil_to_tensor(Image.open(fp).convert("RGB")).to(device)
 
 # custom dataset class 
 class SmiskiDataset(Dataset):
@@ -50,11 +66,39 @@ class SmiskiDataset(Dataset):
     def __getitem__(self, index):
         img_path = self.image_paths[index]
         label = self.labels[index]
-        image = Image.open(img_path).convert("RGB")
+        image = read_image(img_path)
         if self.transforms:
             image = self.transforms(image)
         return image, label
     
+def _labels_path(cache_path):
+    return Path(cache_path).with_suffix(".labels.npy")
+
+def _index_path(cache_path):
+    return Path(cache_path).with_suffix(".index.json")
+
+def _cache_index(image_paths, labels):
+    # ordered (path, mtime, label) rows; any change in content, order or labels invalidates the cache
+    return [[str(p), os.stat(p).st_mtime_ns, int(l)] for p, l in zip(image_paths, labels)]
+
+class CachedSmiskiDataset(Dataset):
+    """Serves pre-resized uint8 images from a cache written by SmiskiClassifier.cache_dataset()."""
+    def __init__(self, cache_path, indices):
+        self.cache_path = str(cache_path)
+        self.indices = indices
+        self.labels = np.load(_labels_path(cache_path))
+        self._images = None
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, index):
+        if self._images is None:
+            # mapped lazily so every loader worker maps the file itself instead of pickling it
+            self._images = np.load(self.cache_path, mmap_mode="c")
+        i = self.indices[index]
+        return torch.from_numpy(self._images[i]), int(self.labels[i])
+
 class SmiskiClassifier:
     def __init__(self, device=DEVICE, model_name="resnet50", pretrained=True, lr=LEARNING_RATE, batch_size=BATCH_SIZE):
         self.device = device
@@ -65,6 +109,16 @@ class SmiskiClassifier:
         self.model = None 
         self.criterion = nn.CrossEntropyLoss()
         self.optimizer = None 
+        self.session = None
+        self.dtype = torch.float32
+        # channels_last only pays off with cuDNN; MPS/CPU convs stay on the default layout
+        self.memory_format = torch.channels_last if self.device.type == "cuda" else torch.contiguous_format
+
+        # Normalize folded into a single affine: x * scale + bias on raw 0-255 pixels
+        mean = torch.tensor(MEAN, device=self.device)
+        std = torch.tensor(STD, device=self.device)
+        self._scale = (1.0 / (255.0 * std)).view(3, 1, 1)
+        self._bias = (-mean / std).view(3, 1, 1)
 
     def build_model(self, num_classes=2, freeze_early=True):
         if self.model_name == "resnet50":
@@ -77,58 +131,133 @@ class SmiskiClassifier:
                 param.requires_grad = False 
 
         self.model.fc = nn.Linear(self.model.fc.in_features, num_classes)
-        self.model = self.model.to(self.device)
+        self.model = self.model.to(self.device, memory_format=self.memory_format)
+        # input shape is fixed at 224x224, so let cudnn pick the fastest conv algorithms once
+        torch.backends.cudnn.benchmark = True
 
         self.optimizer = optim.Adam(filter(lambda p: p.requires_grad, self.model.parameters()), lr=self.lr)
+        self.scaler = torch.amp.GradScaler("cuda", enabled=self.device.type == "cuda")
+
+    def _autocast(self):
+        # fp16 autocast on CUDA only; elsewhere this is a no-op context
+        use_amp = self.device.type == "cuda"
+        return torch.autocast(device_type="cuda" if use_amp else "cpu", dtype=torch.float16, enabled=use_amp)
 
-    def prepare_data(self, image_paths, labels, val_split=0.2, shuffle=True, random_state=42):
-        train_paths, val_paths, train_labels, val_labels = train_test_split(
-            image_paths, labels, test_size=val_split, shuffle=shuffle, random_state=random_state
+    def cache_dataset(self, image_paths, labels, cache_path):
+        """Decode and resize every image once into an (N, 3, 224, 224) uint8 .npy file plus a labels .npy.
+
+        An index of the source paths, mtimes and labels is written last, so
+        prepare_data() can tell whether the cache still matches the dataset.
+        """
+        images = np.lib.format.open_memmap(
+            cache_path, mode="w+", dtype=np.uint8, shape=(len(image_paths), 3, IMG_SIZE, IMG_SIZE)
         )
+        for i, img_path in enumerate(image_paths):
+            images[i] = base_transforms(read_image(img_path)).numpy()
+        images.flush()
+        del images
+        np.save(_labels_path(cache_path), np.asarray(labels, dtype=np.int64))
+        with _index_path(cache_path).open("w", encoding="utf-8") as fh:
+            json.dump(_cache_index(image_paths, labels), fh)
+
+    def _cache_is_current(self, image_paths, labels, cache_path):
+        index_path = _index_path(cache_path)
+        if not (Path(cache_path).exists() and _labels_path(cache_path).exists() and index_path.exists()):
+            return False
+        with index_path.open("r", encoding="utf-8") as fh:
+            return json.load(fh) == _cache_index(image_paths, labels)
 
-        train_ds = SmiskiDataset(train_paths, train_labels, transforms=train_transforms)
-        val_ds = SmiskiDataset(val_paths, val_labels, transforms=val_transforms)
+    def prepare_data(self, image_paths, labels, val_split=0.2, shuffle=True, random_state=42, num_workers=NUM_WORKERS, cache_path=None):
+        if cache_path is not None:
+            if not self._cache_is_current(image_paths, labels, cache_path):
+                self.cache_dataset(image_paths, labels, cache_path)
+            train_idx, val_idx = train_test_split(
+                np.arange(len(image_paths)), test_size=val_split, shuffle=shuffle, random_state=random_state
+            )
+            train_ds = CachedSmiskiDataset(cache_path, train_idx)
+            val_ds = CachedSmiskiDataset(cache_path, val_idx)
+        else:
+            train_paths, val_paths, train_labels, val_labels = train_test_split(
+                image_paths, labels, test_size=val_split, shuffle=shuffle, random_state=random_state
+            )
+
+            # decode in the loader workers on CPU (CUDA can't be used from forked workers)
+            train_ds = SmiskiDataset(train_paths, train_labels, transforms=base_transforms)
+            val_ds = SmiskiDataset(val_paths, val_labels, transforms=base_transforms)
+
+        loader_kwargs = dict(
+            batch_size=self.batch_size,
+            num_workers=num_workers,
+            pin_memory=self.device.type == "cuda",
+        )
+        if num_workers > 0:
+            # DataLoader rejects these with num_workers=0 (in-process loading, handy for debugging)
+            loader_kwargs.update(persistent_workers=True, prefetch_factor=4)
+        # drop the ragged last batch only when there's at least one full batch to train on
+        drop_last = len(train_ds) >= self.batch_size
+        self.train_loader = DataLoader(train_ds, shuffle=True, drop_last=drop_last, **loader_kwargs)
+        self.val_loader = DataLoader(val_ds, shuffle=False, **loader_kwargs)
 
-        self.train_loader = DataLoader(train_ds, batch_size=self.batch_size, shuffle=True)
-        self.val_loader = DataLoader(val_ds, batch_size=self.batch_size, shuffle=False)
+    def _normalize(self, images):
+        # out-of-place mul: .float() (and resize) may hand back the caller's own tensor
+        return images.float().mul(self._scale).add_(self._bias)
+
+    def _augment(self, images):
+        """Random horizontal flip + rotation as a single resample per sample, then normalize."""
+        n = images.size(0)
+        angle = torch.empty(n, device=images.device).uniform_(-MAX_ROTATION, MAX_ROTATION).deg2rad_()
+        flip = torch.randint(0, 2, (n,), device=images.device).float().mul_(2).sub_(1)
+        cos, sin = angle.cos(), angle.sin()
+        zero = torch.zeros_like(angle)
+        theta = torch.stack([
+            torch.stack([cos * flip, -sin, zero], dim=1),
+            torch.stack([sin * flip, cos, zero], dim=1),
+        ], dim=1)
+        grid = F.affine_grid(theta, list(images.shape), align_corners=False)
+        x = F.grid_sample(images.float(), grid, mode="bilinear", padding_mode="zeros", align_corners=False)
+        return x.mul_(self._scale).add_(self._bias)
 
     def _train_epoch(self):
         self.model.train()
-        total_loss = 0.0
-        correct = 0
+        # accumulate on the device so the loop never syncs with the host
+        total_loss = torch.zeros((), device=self.device)
+        correct = torch.zeros((), device=self.device, dtype=torch.long)
         total = 0
         for images, labels in self.train_loader:
-            images, labels = images.to(self.device), labels.to(self.device)
+            images, labels = images.to(self.device, non_blocking=True), labels.to(self.device, non_blocking=True)
+            images = self._augment(images).contiguous(memory_format=self.memory_format)
             self.optimizer.zero_grad()
-            outputs = self.model(images)
-            loss = self.criterion(outputs, labels)
-            loss.backward()
-            self.optimizer.step()
-
-            total_loss += loss.item() * images.size(0)
-            _, preds = torch.max(outputs, 1)
-            correct += (preds == labels).sum().item()
+            with self._autocast():
+                outputs = self.model(images)
+                loss = self.criterion(outputs, labels)
+            self.scaler.scale(loss).backward()
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
+
+            total_loss += loss.detach() * images.size(0)
+            correct += (outputs.argmax(1) == labels).sum()
             total += labels.size(0)
 
-        return total_loss / total, correct / total
+        return total_loss.item() / total, correct.item() / total
     
     def _validate_epoch(self):
         self.model.eval()
-        total_loss = 0.0
-        correct = 0
+        total_loss = torch.zeros((), device=self.device)
+        correct = torch.zeros((), device=self.device, dtype=torch.long)
         total = 0
         with torch.no_grad():
             for images, labels in self.val_loader:
-                images, labels = images.to(self.device), labels.to(self.device)
-                outputs = self.model(images)
-                loss = self.criterion(outputs, labels)
+                images, labels = images.to(self.device, non_blocking=True), labels.to(self.device, non_blocking=True)
+                images = self._normalize(images).contiguous(memory_format=self.memory_format)
+                with self._autocast():
+                    outputs = self.model(images)
+                    loss = self.criterion(outputs, labels)
 
-                total_loss += loss.item() * images.size(0)
-                _, preds = torch.max(outputs, 1)
-                correct += (preds == labels).sum().item()
+                total_loss += loss * images.size(0)
+                correct += (outputs.argmax(1) == labels).sum()
                 total += labels.size(0)
 
-        return total_loss / total, correct / total
+        return total_loss.item() / total, correct.item() / total
     
     def train(self, epochs=EPOCHS):
         if self.model is None:
@@ -144,26 +273,77 @@ class SmiskiClassifier:
     def load(self, path, num_classes=2, freeze_early=True):
         self.build_model(num_classes=num_classes, freeze_early=freeze_early)
         self.model.load_state_dict(torch.load(path, map_location=self.device, weights_only=True))
+        self.model.eval()
 
-    def predict(self, img):
-        if isinstance(img, (str, Path)):
-            img = Image.open(str(img)).convert("RGB")
-        x = val_transforms(img).unsqueeze(0).to(self.device)
+    def to_half(self):
+        """Switch the model to fp16 channels-last for CUDA inference; inputs are converted to match."""
+        self.memory_format = torch.channels_last
+        self.model = self.model.to(memory_format=self.memory_format).half()
+        self.dtype = torch.float16
+
+    def export_onnx(self, path="smiski_classifier.onnx"):
         self.model.eval()
-        with torch.no_grad():
-            out = self.model(x)
-            probs = torch.softmax(out, dim=1).cpu().numpy()[0]
-            pred = int(probs.argmax())
-        return {"pred": pred, "probs": probs}
+        example = torch.zeros(1, 3, IMG_SIZE, IMG_SIZE, device=self.device)
+        export_kwargs = {}
+        if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+            # newer torch defaults to the dynamo exporter, which also needs onnxscript;
+            # the TorchScript exporter only needs the onnx package (see environment.yml)
+            export_kwargs["dynamo"] = False
+        torch.onnx.export(
+            self.model, example, path, opset_version=17,
+            input_names=["x"], output_names=["logits"],
+            dynamic_axes={"x": {0: "B"}, "logits": {0: "B"}},
+            **export_kwargs,
+        )
+
+    def load_onnx(self, path, num_threads=None):
+        """Serve predictions from an exported ONNX graph with ONNX Runtime's CPU provider."""
+        import onnxruntime as ort  # only needed when serving from ONNX
+
+        so = ort.SessionOptions()
+        so.intra_op_num_threads = num_threads or os.cpu_count()
+        so.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(str(path), sess_options=so, providers=["CPUExecutionProvider"])
+
+    def preprocess(self, img):
+        if isinstance(img, (str, Path, bytes, bytearray)):
+            img = read_image(img, device=self.device)
+        elif isinstance(img, Image.Image):
+            img = TF.pil_to_tensor(img.convert("RGB"))
+        img = img.to(self.device, non_blocking=True)
+        img = TF.resize(img, [IMG_SIZE, IMG_SIZE], antialias=True)
+        return self._normalize(img).to(self.dtype)
+
+    def predict_batch(self, x):
+        with torch.inference_mode():
+            if self.session is not None:
+                out = torch.from_numpy(self.session.run(None, {"x": x.cpu().numpy()})[0])
+            else:
+                out = self.model(x.to(self.dtype, memory_format=self.memory_format))
+            # one device->host copy for the whole batch; the per-row softmax over
+            # a handful of logits is cheaper in plain Python than another kernel
+            logits = out.float().tolist()
+        results = []
+        for row in logits:
+            m = max(row)
+            exps = [math.exp(v - m) for v in row]
+            total = sum(exps)
+            probs = tuple(e / total for e in exps)
+            results.append({"pred": max(range(len(probs)), key=probs.__getitem__), "probs": probs})
+        return results
+
+    def predict(self, img):
+        return self.predict_batch(self.preprocess(img).unsqueeze(0))[0]
     
 if __name__ == "__main__":
     # quick run example
     image_paths, labels = load_data()
     clf = SmiskiClassifier()
     clf.build_model()
-    clf.prepare_data(image_paths, labels)
+    clf.prepare_data(image_paths, labels, cache_path="smiski_cache.npy")
     clf.train()
     clf.save("smiski_classifier.pt")
+    clf.export_onnx("smiski_classifier.onnx")
 
 
 
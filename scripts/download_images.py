@@ -7,8 +7,13 @@ from PIL import Image
 
 UA = "smiski-detector/0.1 dataset bootstrapper"
 TIMEOUT = aiohttp.ClientTimeout(total=30)
-SAFE_EXTS = {".jpg", ".jpeg", ".png", ".webp"}
+SAFE_EXTS = frozenset({".jpg", ".jpeg", ".png", ".webp"})
+CONTENT_TYPE_EXTS = {
+    "image/jpeg": ".jpg", "image/jpg": ".jpg",
+    "image/png": ".png", "image/webp": ".webp",
+}
 FLICKR_ENDPOINT = "https://api.flickr.com/services/rest/"
+FLUSH_EVERY = 64
 
 FLICKR_LICENSE_MAP = {
     "0": "All Rights Reserved",
@@ -24,10 +29,20 @@ FLICKR_LICENSE_MAP = {
     "10": "CC0",
 }
 
+class _SlugTable(dict):
+    """str.translate table mapping everything outside [a-z0-9._-] to '-', filled in lazily."""
+    allowed = frozenset("abcdefghijklmnopqrstuvwxyz0123456789._-")
+
+    def __missing__(self, code: int) -> str:
+        ch = chr(code)
+        self[code] = ch if ch in self.allowed else "-"
+        return self[code]
+
+_SLUG_TABLE = _SlugTable()
+_DASH_RUN = re.compile(r"-{2,}")
+
 def slugify(s: str) -> str:
-    s = s.lower()
-    s = re.sub(r"[^a-z0-9._-]+", "-", s)
-    s = re.sub(r"-{2,}", "-", s).strip("-")
+    s = _DASH_RUN.sub("-", s.lower().translate(_SLUG_TABLE)).strip("-")
     return s or "img"
 
 def pick_ext(url: str, content_type: Optional[str]) -> str:
@@ -35,16 +50,67 @@ def pick_ext(url: str, content_type: Optional[str]) -> str:
     if uext in SAFE_EXTS:
         return uext
     ct = (content_type or "").split(";")[0].strip().lower()
-    return {
-        "image/jpeg": ".jpg", "image/jpg": ".jpg",
-        "image/png": ".png", "image/webp": ".webp",
-    }.get(ct, ".jpg")
-
-def sha256_bytes(b: bytes) -> str:
-    return hashlib.sha256(b).hexdigest()
+    return CONTENT_TYPE_EXTS.get(ct, ".jpg")
+
+PNG_SIG = b"\x89PNG\r\n\x1a\n"
+# SOFn markers carry the frame size; C4 (DHT), C8 (JPG) and CC (DAC) don't
+JPEG_SOF = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+def sha256_bytes(b: bytes) -> bytes:
+    return hashlib.sha256(b).digest()
+
+def url_digest(url: str) -> bytes:
+    return hashlib.blake2b(url.encode(), digest_size=16).digest()
+
+class BloomFilter:
+    """Fixed-size Bloom filter over uniformly distributed digests, sized up front for ``capacity`` items."""
+
+    def __init__(self, capacity: int, error_rate: float = 1e-5):
+        capacity = max(1, capacity)
+        self.m = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.k = max(1, round(self.m / capacity * math.log(2)))
+        self.bits = bytearray((self.m + 7) // 8)
+
+    def _positions(self, digest: bytes):
+        # k independent 64-bit indices from an extendable-output hash of the digest;
+        # double hashing (h1 + i*h2) correlates the probes and misses the target rate
+        stream = hashlib.shake_256(digest).digest(8 * self.k)
+        return [int.from_bytes(stream[i:i + 8], "little") % self.m for i in range(0, 8 * self.k, 8)]
+
+    def add(self, digest: bytes) -> None:
+        for p in self._positions(digest):
+            self.bits[p >> 3] |= 1 << (p & 7)
+
+    def __contains__(self, digest: bytes) -> bool:
+        return all(self.bits[p >> 3] & (1 << (p & 7)) for p in self._positions(digest))
+
+def _jpeg_w_h(b: bytes) -> Tuple[Optional[int], Optional[int]]:
+    i, n = 2, len(b)
+    while i + 9 <= n:
+        if b[i] != 0xFF:
+            return None, None
+        marker = b[i + 1]
+        if marker == 0xFF:
+            i += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            i += 2
+            continue
+        if marker in JPEG_SOF:
+            return int.from_bytes(b[i + 7:i + 9], "big"), int.from_bytes(b[i + 5:i + 7], "big")
+        i += 2 + int.from_bytes(b[i + 2:i + 4], "big")
+    return None, None
 
 def read_w_h(b: bytes) -> Tuple[Optional[int], Optional[int]]:
+    """Image size from the header alone: JPEG SOF / PNG IHDR parsed directly, Pillow for the rest."""
+    if b[:2] == b"\xff\xd8":
+        w, h = _jpeg_w_h(b)
+        if w:
+            return w, h
+    elif b[:8] == PNG_SIG and b[12:16] == b"IHDR":
+        return int.from_bytes(b[16:20], "big"), int.from_bytes(b[20:24], "big")
     try:
+        # Image.open only parses the header; pixels are never decoded here
         im = Image.open(io.BytesIO(b))
         return im.width, im.height
     except Exception:
@@ -102,14 +168,29 @@ async def flickr_search(session: aiohttp.ClientSession, key: str, query: str, li
             break
     return out[:limit]
 
-async def fetch_bytes(session: aiohttp.ClientSession, url: str) -> Tuple[Optional[bytes], Optional[str], int]:
+async def fetch_bytes(session: aiohttp.ClientSession, url: str, min_width: int = 0, min_height: int = 0,
+                      max_peek: int = 16 * 1024) -> Tuple[Optional[bytes], Optional[str], int, Tuple[Optional[int], Optional[int]]]:
+    """Download ``url``, aborting after the first ``max_peek`` bytes if the header says it's too small.
+
+    Returns ``(body, content_type, status, (width, height))``; body is None for
+    errors and early rejects, and the size is None when the header didn't fit in the peek.
+    """
     try:
         async with session.get(url, headers={"User-Agent": UA}, allow_redirects=True, timeout=TIMEOUT) as r:
             if r.status != 200:
-                return None, None, r.status
-            return await r.read(), r.headers.get("Content-Type"), 200
+                return None, None, r.status, (None, None)
+            ct = r.headers.get("Content-Type")
+            try:
+                peek = await r.content.readexactly(max_peek)
+            except asyncio.IncompleteReadError as e:
+                peek = e.partial  # body shorter than max_peek
+            w, h = read_w_h(peek)
+            if (w and w < min_width) or (h and h < min_height):
+                r.close()
+                return None, ct, 200, (w, h)
+            return peek + await r.content.read(), ct, 200, (w, h)
     except Exception:
-        return None, None, -1
+        return None, None, -1, (None, None)
 
 async def main():
     ap = argparse.ArgumentParser(description="Flickr image downloader with manifest")
@@ -159,33 +240,34 @@ async def main():
             print(f"[flickr] {len(all_records)} candidate URLs")
 
             sem = asyncio.Semaphore(args.concurrency)
-            seen_urls, seen_hashes = set(), set()
+            # a false positive only drops one candidate image, so no exact fallback set is kept
+            seen_urls, seen_hashes = BloomFilter(len(all_records)), BloomFilter(len(all_records))
             lock = asyncio.Lock()
 
-            async def worker(rec: Dict[str, Any]) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+            async def fetch_record(rec: Dict[str, Any]) -> Tuple[Dict[str, Any], Dict[str, Any]]:
                 async with sem:
                     url = rec.get("source_url")
                     if not url:
                         return rec, {"status": "skip", "reason": "no_url"}
 
                     async with lock:
-                        if url in seen_urls:
+                        if url_digest(url) in seen_urls:
                             return rec, {"status": "skip", "reason": "dup_url"}
 
-                    b, ct, status = await fetch_bytes(session, url)
+                    b, ct, status, (w, h) = await fetch_bytes(session, url, args.min_width, args.min_height)
+                    if b and w is None:
+                        w, h = read_w_h(b)
+                    if (w and w < args.min_width) or (h and h < args.min_height):
+                        return rec, {"status": "skip", "reason": "too_small", "width": w, "height": h}
                     if not b:
                         return rec, {"status": "skip", "reason": f"http_{status}"}
 
-                    hsh = sha256_bytes(b)
+                    digest = sha256_bytes(b)
 
                     async with lock:
-                        if hsh in seen_hashes:
+                        if digest in seen_hashes:
                             return rec, {"status": "skip", "reason": "dup_hash"}
 
-                    w, h = read_w_h(b)
-                    if (w and w < args.min_width) or (h and h < args.min_height):
-                        return rec, {"status": "skip", "reason": "too_small", "width": w, "height": h}
-
                     ext = pick_ext(url, ct)
                     fname = f"{slugify(rec['query'])}-{int(time.time()*1000)}-{random.randint(1000,9999)}{ext}"
                     path = outdir / fname
@@ -196,18 +278,16 @@ async def main():
                         return rec, {"status": "skip", "reason": "write_error"}
 
                     async with lock:
-                        seen_urls.add(url)
-                        seen_hashes.add(hsh)
+                        seen_urls.add(url_digest(url))
+                        seen_hashes.add(digest)
 
-                    return rec, {"status": "ok", "filepath": str(path), "sha256": hsh, "width": w, "height": h}
-
-            tasks = [asyncio.create_task(worker(r)) for r in all_records if r.get("source_url")]
-            done = 0
+                    return rec, {"status": "ok", "filepath": str(path), "sha256": digest.hex(), "width": w, "height": h}
 
-            for fut in asyncio.as_completed(tasks):
-                rec, res = await fut
-                row = {
-                    "id": hashlib.md5((rec["source_url"] or str(time.time())).encode()).hexdigest(),
+            async def worker(rec: Dict[str, Any]) -> Dict[str, Any]:
+                # build the manifest row here so hashing/formatting overlaps other downloads
+                rec, res = await fetch_record(rec)
+                return {
+                    "id": hashlib.md5(rec["source_url"].encode()).hexdigest(),
                     "label": args.label,
                     "query": rec["query"],
                     "provider": rec["provider"],
@@ -221,11 +301,30 @@ async def main():
                     "status": res["status"],
                     "reason": res.get("reason"),
                 }
-                writer.writerow(row)
-                jsonlf.write(json.dumps(row, ensure_ascii=False) + "\n")
-                done += 1
-                if done % 25 == 0:
-                    print(f"downloaded {done}/{len(tasks)}")
+
+            tasks = [asyncio.create_task(worker(r)) for r in all_records if r.get("source_url")]
+            done = 0
+            buf: List[Dict[str, Any]] = []
+
+            def flush_rows():
+                writer.writerows(buf)
+                jsonlf.writelines(json.dumps(r, ensure_ascii=False, separators=(",", ":")) + "\n" for r in buf)
+                csvf.flush()
+                jsonlf.flush()
+                buf.clear()
+
+            try:
+                for fut in asyncio.as_completed(tasks):
+                    row = await fut
+                    buf.append(row)
+                    if len(buf) >= FLUSH_EVERY:
+                        flush_rows()
+                    done += 1
+                    if done % 25 == 0:
+                        print(f"downloaded {done}/{len(tasks)}")
+            finally:
+                # rows for images already on disk must reach the manifest even on Ctrl-C/errors
+                flush_rows()
 
             print(f"✅ Done. Saved to {outdir}")
             print(f"   Manifest CSV:   {csv_path}")